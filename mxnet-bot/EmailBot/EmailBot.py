@@ -18,22 +18,109 @@
 from __future__ import print_function
 from collections import defaultdict
 from botocore.exceptions import ClientError
-from botocore.vendored import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
 from email.mime.multipart import MIMEMultipart
 from email.mime.image import MIMEImage
 from email.mime.text import MIMEText
 import datetime
+import heapq
 import operator
 import boto3
 import datetime
 import logging
 import os
 import re
+import requests
+import threading
+import time
+from urllib3.util.retry import Retry
+
+
+# fields of an issue kept in the sorted issue lists
+_SLIM_KEYS = ('number', 'html_url', 'title')
+_slim = operator.itemgetter(*_SLIM_KEYS)
+
+_CACHE_TTL = 120  # Seconds a cached GitHub response is reused without asking GitHub
+_CACHE_SIZE = 4096  # Limit for total cached GitHub responses
+_github_cache = {}
+_github_cache_lock = threading.Lock()
+# page number of the rel="last" link in the Link header of a listing
+_LAST_PAGE_RE = re.compile(r'[?&]page=(\d+)[^>]*>;\s*rel="last"')
+_BODY_TTL = 1800  # Seconds a generated report is reused, ie: when the email is sent again
+_body_cache = {}
+
+
+def _github_get(session, url, params=None, auth=None):
+    """
+    This method is to send a GET request to the GitHub API through a TTL cache.
+    Expired entries are revalidated with their ETag (or Last-Modified date):
+    GitHub then answers 304 Not Modified, which does not count against the
+    rate limit, and the cached response is returned again.
+    Only successful responses are cached.
+    """
+    key = (url, frozenset(params.items()) if params else None)
+    entry = _github_cache.get(key)
+    if entry and time.monotonic() - entry[0] < _CACHE_TTL:
+        return entry[1]
+    headers = {}
+    if entry and 'ETag' in entry[1].headers:
+        headers['If-None-Match'] = entry[1].headers['ETag']
+    elif entry and 'Last-Modified' in entry[1].headers:
+        headers['If-Modified-Since'] = entry[1].headers['Last-Modified']
+    response = session.get(url, params=params, auth=auth, headers=headers)
+    if entry and response.status_code == 304:
+        response = entry[1]
+    elif response.status_code != 200:
+        return response
+    # the cache is shared by worker threads, evicting and inserting must not interleave
+    with _github_cache_lock:
+        if len(_github_cache) >= _CACHE_SIZE and key not in _github_cache:
+            # drop the oldest entry
+            del _github_cache[next(iter(_github_cache))]
+        _github_cache[key] = (time.monotonic(), response)
+    return response
+
+
+def _parse_time(timestamp):
+    """
+    This method is to parse GitHub's UTC timestamps. ie: "2018-08-04T18:27:17Z"
+    Slicing the fixed-width fields is much faster than datetime.strptime
+    """
+    return datetime.datetime(int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10]),
+                             int(timestamp[11:13]), int(timestamp[14:16]), int(timestamp[17:19]))
+
+
+def _created(item):
+    """
+    This method is to get the creation time of an issue,
+    the parsed value is stored on the issue so that it is only parsed once
+    """
+    if '_created' not in item:
+        item['_created'] = _parse_time(item['created_at'])
+    return item['_created']
+
+
+def _create_session():
+    """
+    This method is to create a requests session for the GitHub API.
+    Connections are pooled and kept alive between requests, and throttled
+    or failed requests are retried with backoff (honouring Retry-After)
+    """
+    session = requests.Session()
+    retries = Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 502, 503, 504],
+                    respect_retry_after_header=True)
+    session.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=retries))
+    session.headers.update({'Accept': 'application/vnd.github+json'})
+    return session
 
 
 class EmailBot:
+    PER_PAGE = 100  # Limit for total issues per page, the maximum GitHub allows
+    PAGE_BATCH = 10  # Number of issue pages fetched concurrently
+    COMMENT_WORKERS = 16  # Number of issue comments fetched concurrently
 
-    def __init__(self, img_file="/tmp/img_file.png", sla_days=5,
+    def __init__(self, img_file=None, sla_days=5,
                  github_user = os.environ.get("github_user"),
                  github_oauth_token = os.environ.get("github_oauth_token"),
                  repo = os.environ.get("repo"),
@@ -44,7 +131,7 @@ class EmailBot:
         """
         This EmailBot serves to send github issue reports to recipients.
         Args:
-            img_file(str): the path of image file which will be attached in email content
+            img_file(str): optional path to also save the pie chart attached in email content, for debugging
             github_user(str): the github id. ie: "CathyZhang0822"
             github_oauth_token(str): the github oauth token, paired with github_user to realize authorization
             repo(str): the repo name
@@ -57,27 +144,24 @@ class EmailBot:
         self.github_oauth_token = github_oauth_token
         self.repo = repo
         self.auth = (self.github_user, self.github_oauth_token)
+        # auth is passed per GitHub request, the session is also used for the EB web server
+        self.session = _create_session()
         self.sender = sender
         self.recipients = [s.strip() for s in recipients.split(",")] if recipients else None
         self.aws_region = aws_region
         self.elastic_beanstalk_url = elastic_beanstalk_url if elastic_beanstalk_url[-1]!="/" else elastic_beanstalk_url[:-1]
         self.img_file = img_file
+        self.img_bytes = None
         self.open_issues = None
         self.closed_issues = None
         self.sorted_open_issues = None
         self.start = datetime.datetime.strptime("2015-01-01", "%Y-%m-%d")
         self.end = datetime.datetime.today()+datetime.timedelta(days=2)
+        self.__format_period()
         self.sla_days = sla_days
         # 2018-5-15 is the date that 'issues outside sla' concept was used.
         self.sla_start = datetime.datetime.strptime("2018-05-15", "%Y-%m-%d")
 
-    def __clean_string(self, raw_string, sub_string):
-        """
-        This method is to convert all non-alphanumeric characters from raw_string to sub_string
-        """
-        cleans = re.sub("[^0-9a-zA-Z]", sub_string, raw_string)
-        return cleans.lower()
-
     def __set_period(self, period_days):
         """
         This method is to set the time period. ie: set_period(7)
@@ -91,28 +175,37 @@ class EmailBot:
         self.end = today + datetime.timedelta(days=2)
         timedelta = datetime.timedelta(days=period_days)
         self.start = self.end - timedelta
+        self.__format_period()
+
+    def __format_period(self):
+        """
+        This method is to format the reported period once for the email, ie: "2018-07-04" to "2018-07-10"
+        self.end is 2 days after the last reported date, see set_period
+        """
+        self._start_str = self.start.date().isoformat()
+        self._end_str = (self.end - datetime.timedelta(days=2)).date().isoformat()
 
-    def __count_pages(self, obj, state='all'):
+    def __count_pages(self, obj, params=None):
         """
         This method is to count how many pages of issues/labels in total
         obj could be "issues"/"labels"
-        state could be "open"/"closed"/"all", available to issues
+        params are the query parameters of the listing. ie: {'state': 'all'} for issues
+        Returns the count of pages and the first page's items, so that callers
+        don't need to request the first page again
         """
         assert obj in set(["issues", "labels"]), "Invalid Input!"
         url = 'https://api.github.com/repos/{}/{}'.format(self.repo, obj)
-        if obj == 'issues':
-            response = requests.get(url, {'state': state},
-                                    auth=self.auth)
-        else:
-            response = requests.get(url, auth=self.auth)
+        params = dict(params or {}, per_page=self.PER_PAGE)
+        response = _github_get(self.session, url, params, auth=self.auth)
         assert response.status_code == 200, response.status_code
         if "link" not in response.headers:
             # That means only 1 page exits
-            return 1
+            return 1, response.json()
         # response.headers['link'] will looks like:
         # <https://api.github.com/repositories/34864402/issues?state=all&page=387>; rel="last"
         # In this case we need to extrac '387' as the count of pages
-        return int(self.__clean_string(response.headers['link'], " ").split()[-3])
+        last_page = _LAST_PAGE_RE.search(response.headers['link'])
+        return int(last_page.group(1)) if last_page else 1, response.json()
 
     def read_repo(self, periodically=True, period_days=8):
         """
@@ -126,39 +219,71 @@ class EmailBot:
         else:
             self.start = self.sla_start
             self.end = datetime.datetime.today()+datetime.timedelta(days=2)
-        pages = self.__count_pages('issues', 'all')
+            self.__format_period()
+        url = 'https://api.github.com/repos/{}/issues'.format(self.repo)
+        params = {'state': 'all',
+                  'base': 'master',
+                  'sort': 'created',
+                  'direction': 'desc'}
+        pages, first_page_items = self.__count_pages('issues', params)
         open_issues = []
         closed_issues = []
-        # nested function to help break out of multiple loops
-        def read_issues(response):
-            for item in response.json():
+        # nested function so that pages can be parsed in worker threads
+        def read_issues(items):
+            """
+            Returns (open issues, closed issues, past_start) of one page.
+            past_start is True once an issue created before self.start is seen,
+            since issues are sorted by creation date the following pages can be skipped.
+            """
+            page_open_issues = []
+            page_closed_issues = []
+            for item in items:
                 if "pull_request" in item:
                     continue
-                created = datetime.datetime.strptime(item['created_at'], "%Y-%m-%dT%H:%M:%SZ")
+                created = _created(item)
                 if self.start <= created <= self.end:
                     if item['state'] == 'open':
-                        open_issues.append(item)
+                        page_open_issues.append(item)
                     elif item['state'] == 'closed':
-                        closed_issues.append(item)
+                        page_closed_issues.append(item)
                 else:
-                    return True
-            return False
-
-        for page in range(1, pages + 1):
-            url = 'https://api.github.com/repos/' + self.repo + '/issues?page=' + str(page) \
-                  + '&per_page=30'.format(repo=self.repo)
-            response = requests.get(url,
-                                    {'state': 'all',
-                                     'base': 'master',
-                                     'sort': 'created',
-                                     'direction': 'desc'},
-                                    auth=self.auth)
+                    return page_open_issues, page_closed_issues, True
+            return page_open_issues, page_closed_issues, False
+
+        def fetch_issues(page):
+            response = _github_get(self.session, url,
+                                   dict(params, page=page, per_page=self.PER_PAGE),
+                                   auth=self.auth)
             response.raise_for_status()
-            if read_issues(response):
-                break
+            return read_issues(response.json())
+
+        open_issues, closed_issues, past_start = read_issues(first_page_items)
+        # the remaining pages are requested in batches, the next batch is only
+        # submitted if no page of the current batch went past self.start
+        with ThreadPoolExecutor(max_workers=self.PAGE_BATCH) as executor:
+            for first_page in range(2, pages + 1, self.PAGE_BATCH):
+                if past_start:
+                    break
+                batch = range(first_page, min(first_page + self.PAGE_BATCH, pages + 1))
+                for page_open_issues, page_closed_issues, past_start in executor.map(fetch_issues, batch):
+                    open_issues += page_open_issues
+                    closed_issues += page_closed_issues
+                    if past_start:
+                        break
         self.open_issues = open_issues
         self.closed_issues = closed_issues
 
+    def __filter_period(self, period_days=8):
+        """
+        This method is to keep only the read issues which are created in a specific time period
+        The period must be covered by the one of the last read_repo call. ie: filter_period(8)
+        """
+        self.__set_period(period_days)
+        self.open_issues = [item for item in self.open_issues
+                            if self.start <= _created(item) <= self.end]
+        self.closed_issues = [item for item in self.closed_issues
+                              if self.start <= _created(item) <= self.end]
+
     def sort(self):
         """
         This method is to sort open issues.
@@ -167,62 +292,67 @@ class EmailBot:
         assert self.open_issues, "No open issues in this time period!"
         items = self.open_issues
         labelled = []
-        labelled_urls = ""
+        labelled_urls = []
         unlabelled = []
-        unlabelled_urls = ""
+        unlabelled_urls = []
         labels = {}
         labels = defaultdict(lambda: 0, labels)
         non_responded = []
-        non_responded_urls = ""
+        non_responded_urls = []
         outside_sla = []
-        outside_sla_urls = ""
+        outside_sla_urls = []
         responded = []
-        responded_urls = ""
+        responded_urls = []
+        responded_created = []
         total_deltas = []
+        sla_deadline = datetime.datetime.now() - datetime.timedelta(days=self.sla_days)
 
         for item in items:
             url = "<a href='" + item['html_url'] + "'>" + str(item['number']) + "</a>   "
-            created = datetime.datetime.strptime(item['created_at'], "%Y-%m-%dT%H:%M:%SZ")
+            created = _created(item)
+            slim = dict(zip(_SLIM_KEYS, _slim(item)))
             if item['labels']:
-                labelled += [{k: v for k, v in item.items()
-                              if k in ['number', 'html_url', 'title']}]
-                labelled_urls = labelled_urls + url
+                labelled.append(slim)
+                labelled_urls.append(url)
                 for label in item['labels']:
                     labels[label['name']] += 1
             else:
-                unlabelled += [{k: v for k, v in item.items()
-                                if k in ['number', 'html_url', 'title']}]
-                unlabelled_urls = unlabelled_urls + url
+                unlabelled.append(slim)
+                unlabelled_urls.append(url)
             if item['comments'] == 0:
-                non_responded += [{k: v for k, v in item.items()
-                                   if k in ['number', 'html_url', 'title']}]
-                non_responded_urls = non_responded_urls + url
-                if self.sla_start < created < datetime.datetime.now() - datetime.timedelta(days=self.sla_days):
-                    outside_sla += [{k: v for k, v in item.items()
-                                     if k in ['number', 'html_url', 'title']}]
-                    outside_sla_urls = outside_sla_urls + url
+                non_responded.append(slim)
+                non_responded_urls.append(url)
+                if self.sla_start < created < sla_deadline:
+                    outside_sla.append(slim)
+                    outside_sla_urls.append(url)
             else:
-                responded += [{k: v for k, v in item.items()
-                               if k in ['number', 'html_url', 'title']}]
-                responded_urls = responded_urls + url
-                comments_url = item['comments_url']
-                comments = requests.get(comments_url, auth=self.auth)
-                first_comment_created = datetime.datetime.strptime(comments.json()[0]['created_at'],
-                                                                   "%Y-%m-%dT%H:%M:%SZ")
-                delta = first_comment_created - created
-                total_deltas.append(delta)
+                responded.append(slim)
+                responded_urls.append(url)
+                responded_created.append((item['comments_url'], created))
+
+        # the first comment of each responded issue is fetched concurrently
+        def first_comment_created(comments_url):
+            comments = _github_get(self.session, comments_url, auth=self.auth)
+            return _parse_time(comments.json()[0]['created_at'])
+
+        if responded_created:
+            with ThreadPoolExecutor(max_workers=self.COMMENT_WORKERS) as executor:
+                first_comments = executor.map(first_comment_created,
+                                              [comments_url for comments_url, _ in responded_created])
+                for (_, created), first_comment in zip(responded_created, first_comments):
+                    total_deltas.append(first_comment - created)
         labels['unlabelled'] = len(unlabelled)
         sorted_open_issues = {"labelled": labelled,
                 "labels" : labels,
-                "labelled_urls": labelled_urls,
+                "labelled_urls": "".join(labelled_urls),
                 "unlabelled": unlabelled,
-                "unlabelled_urls": unlabelled_urls,
+                "unlabelled_urls": "".join(unlabelled_urls),
                 "responded": responded,
-                "responded_urls": responded_urls,
+                "responded_urls": "".join(responded_urls),
                 "non_responded": non_responded,
-                "non_responded_urls": non_responded_urls,
+                "non_responded_urls": "".join(non_responded_urls),
                 "outside_sla": outside_sla,
-                "outside_sla_urls": outside_sla_urls,
+                "outside_sla_urls": "".join(outside_sla_urls),
                 "total_deltas": total_deltas}
         self.sorted_open_issues = sorted_open_issues
         return sorted_open_issues
@@ -239,7 +369,7 @@ class EmailBot:
         unlabeled_issue_number = [item['number'] for item in issues["unlabelled"]]
         logging.info("Start predicting labels for: {}".format(str(unlabeled_issue_number)))
         url = "{}/predict".format(self.elastic_beanstalk_url)
-        response = requests.post(url, json={"issues": unlabeled_issue_number})
+        response = self.session.post(url, json={"issues": unlabeled_issue_number})
         logging.info(response.json())
         return response.json()
 
@@ -251,38 +381,57 @@ class EmailBot:
         Args:
             lol(list of lists): table content
         """
-        yield '<table style="width: 500px;">'
+        parts = ['<table style="width: 500px;">']
         for sublist in lol:
-            yield '  <tr><td style = "width:200px;">'
-            yield '    </td><td style = "width:300px;">'.join(sublist)
-            yield '  </td></tr>'
-        yield '</table>'
+            parts.append('  <tr><td style = "width:200px;">')
+            parts.append('    </td><td style = "width:300px;">'.join(sublist))
+            parts.append('  </td></tr>')
+        parts.append('</table>')
+        return "\n".join(parts)
 
     def __bodyhtml(self):
         """
         This method is to generate body html of email content
+        The report of a day is cached for _BODY_TTL seconds with the pie chart and the
+        reported period, so sending it again does not read the repo again
         """
+        key = (self.repo, datetime.date.today(), self.sla_days)
+        entry = _body_cache.get(key)
+        if entry and time.monotonic() - entry[0] < _BODY_TTL:
+            _, body_html, self.img_bytes, self.start, self.end = entry
+            self.__format_period()
+            return body_html
         self.read_repo(False)
         all_sorted_open_issues = self.sort()
-        self.read_repo(True)
+        # the weekly issues are a subset of all issues, no need to read the repo again
+        self.__filter_period()
         weekly_sorted_open_issues = self.sort()
         # draw the pie chart
         all_labels = weekly_sorted_open_issues['labels']
-        sorted_labels = sorted(all_labels.items(), key=operator.itemgetter(1), reverse=True)
-        labels = [item[0] for item in sorted_labels[:10]]
-        fracs = [item[1] for item in sorted_labels[:10]]
+        top_labels = heapq.nlargest(10, all_labels.items(), key=operator.itemgetter(1))
+        labels = [item[0] for item in top_labels]
+        fracs = [item[1] for item in top_labels]
         url = "{}/draw".format(self.elastic_beanstalk_url)
         pic_data = {"fracs": fracs, "labels": labels}
-        response = requests.post(url, json=pic_data)
+        response = self.session.post(url, json=pic_data)
         if response.status_code == 200:
-            with open(self.img_file, "wb") as f:
-                f.write(response.content)
+            self.img_bytes = response.content
+            if self.img_file:
+                with open(self.img_file, "wb") as f:
+                    f.write(self.img_bytes)
         # generate the first html table
         total_deltas = weekly_sorted_open_issues["total_deltas"]
         if len(total_deltas) != 0:
-            avg = sum(total_deltas, datetime.timedelta())/len(total_deltas)
-            avg_time = str(avg.days)+" days, "+str(int(avg.seconds/3600))+" hours"
-            worst_time = str(max(total_deltas).days)+" days, "+str(int(max(total_deltas).seconds/3600)) + " hours"
+            # sum up and find the worst response time in one pass
+            total = datetime.timedelta()
+            worst = datetime.timedelta()
+            for delta in total_deltas:
+                total += delta
+                if delta > worst:
+                    worst = delta
+            avg = total/len(total_deltas)
+            avg_time = str(avg.days)+" days, "+str(avg.seconds//3600)+" hours"
+            worst_time = str(worst.days)+" days, "+str(worst.seconds//3600) + " hours"
         else:
             avg_time = "N/A"
             worst_time = "N/A"
@@ -300,23 +449,24 @@ class EmailBot:
         # generate the second html tabel
         htmltable2 = [["<a href='" +"https://github.com/{}/issues/{}".format(self.repo,str(item['number']) ) + "'>" + str(item['number']) + "</a>   ", 
                        ",".join(item['predictions'])] for item in self.predict()]
-        body_html = """<html>
+        open_count = len(self.open_issues)
+        closed_count = len(self.closed_issues)
+        table = self.__html_table(htmltable)
+        table2 = self.__html_table(htmltable2)
+        body_html = f"""<html>
         <head>
         </head>
         <body>
-          <h4>Week: {} to {}</h4>
-          <p>{} newly issues were opened in the above period, among which {} were closed and {} are still open.</p>
-          <div>{}</div>
+          <h4>Week: {self._start_str} to {self._end_str}</h4>
+          <p>{open_count + closed_count} newly issues were opened in the above period, among which {closed_count} were closed and {open_count} are still open.</p>
+          <div>{table}</div>
           <p>Here are the recommanded labels for unlabeled issues:</p>
-          <div>{}</div>
+          <div>{table2}</div>
           <p><img src="cid:image1" width="400" height="400"></p>
         </body>
         </html>
-                    """.format(str(self.start.date()), str((self.end - datetime.timedelta(days=2)).date()),
-                               str(len(self.open_issues) + len(self.closed_issues)),
-                               str(len(self.closed_issues)), str(len(self.open_issues)),
-                               "\n".join(self.__html_table(htmltable)),
-                               "\n".join(self.__html_table(htmltable2)))
+                    """
+        _body_cache[key] = (time.monotonic(), body_html, self.img_bytes, self.start, self.end)
         return body_html
 
     def sendemail(self):
@@ -332,8 +482,7 @@ class EmailBot:
         # The HTML body of the email.
         body_html = self.__bodyhtml()
         # The subject line for the email.
-        subject = "GitHub Issues Daily Report {} to {}".format(str(self.start.date()),
-                                                               str((self.end - datetime.timedelta(days=2)).date()))
+        subject = "GitHub Issues Daily Report {} to {}".format(self._start_str, self._end_str)
         # The character encoding for the email.
         charset = "utf-8"
         # Create a new SES resource and specify a region.
@@ -360,11 +509,10 @@ class EmailBot:
         msg.attach(msg_body)
 
         # Attach Image
-        fg = open(self.img_file, 'rb')
-        msg_image = MIMEImage(fg.read())
-        fg.close()
-        msg_image.add_header('Content-ID', '<image1>')
-        msg.attach(msg_image)
+        if self.img_bytes:
+            msg_image = MIMEImage(self.img_bytes)
+            msg_image.add_header('Content-ID', '<image1>')
+            msg.attach(msg_image)
 
         try:
             # Provide the contents of the email.
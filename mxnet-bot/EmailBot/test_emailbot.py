@@ -17,21 +17,29 @@
 import requests
 import unittest
 import boto3
+import datetime
+import email
+import os
+import tempfile
 from botocore.exceptions import ClientError
+import EmailBot as email_bot
 from EmailBot import EmailBot
 # some version issue
 try:
-    from unittest.mock import patch
+    from unittest.mock import patch, MagicMock
 except ImportError:
-    from mock import patch
+    from mock import patch, MagicMock
 
 
 class TestEmailBot(unittest.TestCase):
-  """
-  Unittest of EmailBot.py, coverage:91%
-  """
+    """
+    Unittest of EmailBot.py, coverage:91%
+    """
 
     def setUp(self):
+        # responses cached by earlier tests must not leak into the next one
+        email_bot._github_cache.clear()
+        email_bot._body_cache.clear()
         self.eb = EmailBot(img_file="./test_img.png",
                            elastic_beanstalk_url = "http://fakedocker.us-west-2.elasticbeanstalk.com",
                            repo = "apache/incubator-mxnet",
@@ -40,7 +48,7 @@ class TestEmailBot(unittest.TestCase):
                            aws_region = "us-east-1")
 
     def test_read_repo(self):
-        with patch('EmailBot.requests.get') as mocked_get:
+        with patch.object(self.eb.session, 'get') as mocked_get:
             mocked_get.return_value.status_code = 200
             mocked_get.return_value.json.return_value = [{"body": "issue's body",
                                                           "created_at": "2018-08-04T18:27:17Z",
@@ -62,31 +70,161 @@ class TestEmailBot(unittest.TestCase):
                                                           }]
             self.eb.read_repo(True)
 
+    # a PNG signature is enough for MIMEImage to recognize the pie chart
+    PIE_CHART = b'\x89PNG\r\n\x1a\n' + b'pie chart'
+
+    def _issues(self):
+        """
+        Two open issues created yesterday, so that they are in the weekly report
+        """
+        created = datetime.datetime.today() - datetime.timedelta(days=1)
+        return [{"body": "issue's body",
+                 "created_at": created.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                 "comments": 0,
+                 "number": 11925,
+                 "labels": [{'name': 'Doc'}],
+                 "state": "open",
+                 "title": "issue's title",
+                 "html_url": "https://github.com/apache/incubator-mxnet/issues/11925",
+                 },
+                {"body": "issue's body",
+                 "created_at": created.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                 "comments": 1,
+                 "comments_url": "https://api.github.com/repos/apache/incubator-mxnet/issues/11918/comments",
+                 "number": 11918,
+                 "labels": [],
+                 "state": "open",
+                 "title": "issue's title",
+                 "html_url": "https://github.com/apache/incubator-mxnet/issues/11918",
+                 }]
+
+    def _fake_get(self, url, params=None, auth=None, headers=None):
+        response = MagicMock(status_code=200, headers={})
+        if url.endswith('/comments'):
+            responded = datetime.datetime.today() - datetime.timedelta(hours=3)
+            response.json.return_value = [{"created_at": responded.strftime("%Y-%m-%dT%H:%M:%SZ")}]
+        else:
+            response.json.return_value = self._issues()
+        return response
+
+    def _fake_post(self, url, json=None):
+        response = MagicMock(status_code=200)
+        if url.endswith('/draw'):
+            response.content = self.PIE_CHART
+        else:
+            response.json.return_value = [{'number': 11918, 'predictions': ['Build']}]
+        return response
+
+    @staticmethod
+    def _sent_email(mocked_client):
+        """
+        Returns the message passed to send_raw_email
+        """
+        raw_message = mocked_client.return_value.send_raw_email.call_args[1]['RawMessage']['Data']
+        return email.message_from_string(raw_message)
+
     def test_sendemail(self):
-        with patch('EmailBot.requests.get') as mocked_get, patch('EmailBot.requests.post') as mocked_post:
-            mocked_get.return_value.status_code = 200
-            mocked_get.return_value.json.return_value = [{"body": "issue's body",
-                                                          "created_at": "2018-08-04T18:27:17Z",
-                                                          "comments": 0,
-                                                          "number": 11925,
-                                                          "labels": [{'name': 'Doc'}],
-                                                          "state": "open",
-                                                          "title": "issue's title",
-                                                          "html_url": "https://github.com/apache/incubator-mxnet/issues/11925",
-                                                          },
-                                                         {"body": "issue's body",
-                                                          "created_at": "2018-08-04T18:27:17Z",
-                                                          "comments": 1,
-                                                          "comments_url": "https://api.github.com/repos/apache/incubator-mxnet/issues/11918/comments",
-                                                          "number": 11918,
-                                                          "labels": [],
-                                                          "state":"open",
-                                                          "title":"issue's title",
-                                                          "html_url":"https://github.com/apache/incubator-mxnet/issues/11918",
-                                                          }]
-            mocked_post.return_value.json.return_value = [{'number': 11919, 'predictions': ['Performance']}, 
-                                                          {'number': 11924, 'predictions': ['Build']}]                                             
-            self.assertRaises(ClientError, self.eb.sendemail())
+        img_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(img_dir.cleanup)
+        self.eb.img_file = os.path.join(img_dir.name, "img.png")
+        with patch.object(self.eb.session, 'get', side_effect=self._fake_get), \
+                patch.object(self.eb.session, 'post', side_effect=self._fake_post), \
+                patch('EmailBot.boto3.client') as mocked_client:
+            self.eb.sendemail()
+        mocked_client.assert_called_once_with('ses', region_name="us-east-1")
+        message = self._sent_email(mocked_client)
+        today = datetime.date.today()
+        self.assertEqual(message['Subject'], "GitHub Issues Daily Report {} to {}".format(
+            (today - datetime.timedelta(days=6)).isoformat(), today.isoformat()))
+        body_html = next(part for part in message.walk()
+                         if part.get_content_type() == 'text/html').get_payload(decode=True).decode('utf-8')
+        self.assertIn("2 newly issues were opened in the above period", body_html)
+        self.assertIn("https://github.com/apache/incubator-mxnet/issues/11918", body_html)
+        self.assertIn("Build", body_html)
+        self.assertIn('<img src="cid:image1"', body_html)
+        image = next(part for part in message.walk() if part.get_content_maintype() == 'image')
+        self.assertEqual(image['Content-ID'], '<image1>')
+        self.assertEqual(image.get_payload(decode=True), self.PIE_CHART)
+        with open(self.eb.img_file, "rb") as f:
+            self.assertEqual(f.read(), self.PIE_CHART)
+
+    def test_sendemail_twice(self):
+        self.eb.img_file = None
+        with patch.object(self.eb.session, 'get', side_effect=self._fake_get) as mocked_get, \
+                patch.object(self.eb.session, 'post', side_effect=self._fake_post) as mocked_post, \
+                patch('EmailBot.boto3.client') as mocked_client:
+            self.eb.sendemail()
+            first = self._sent_email(mocked_client)
+            get_count, post_count = mocked_get.call_count, mocked_post.call_count
+            # a new EmailBot sending the report of the same day reuses the cached report
+            eb = EmailBot(elastic_beanstalk_url="http://fakedocker.us-west-2.elasticbeanstalk.com",
+                          repo="apache/incubator-mxnet",
+                          sender="a@email.com",
+                          recipients="a@gmail.com",
+                          aws_region="us-east-1")
+            with patch.object(eb.session, 'get') as mocked_get2, patch.object(eb.session, 'post') as mocked_post2:
+                eb.sendemail()
+            second = self._sent_email(mocked_client)
+        mocked_get2.assert_not_called()
+        mocked_post2.assert_not_called()
+        self.assertEqual((mocked_get.call_count, mocked_post.call_count), (get_count, post_count))
+        self.assertEqual((eb.start, eb.end), (self.eb.start, self.eb.end))
+        self.assertEqual(second['Subject'], first['Subject'])
+        images = [[part.get_payload(decode=True) for part in message.walk() if part.get_content_maintype() == 'image']
+                  for message in (first, second)]
+        self.assertEqual(images[1], images[0])
+        self.assertEqual(images[1], [self.PIE_CHART])
+
+    def test_read_repo_stopsAtPeriodStart(self):
+        # 30 pages of issues sorted by creation date, page p is created p-1 days ago
+        today = datetime.datetime.strptime(str(datetime.datetime.today().date()), "%Y-%m-%d")
+        pages = {}
+        for page in range(1, 31):
+            created = (today - datetime.timedelta(days=page - 1, hours=-12)).strftime("%Y-%m-%dT%H:%M:%SZ")
+            pages[page] = [{"number": page * 10 + i,
+                            "created_at": created,
+                            "state": "open" if i % 2 else "closed",
+                            "title": "issue's title",
+                            "html_url": "https://github.com/apache/incubator-mxnet/issues/%d" % (page * 10 + i)}
+                           for i in range(3)]
+            pages[page][0]["pull_request"] = {}
+
+        def fake_get(url, params=None, auth=None, headers=None):
+            response = MagicMock(status_code=200)
+            response.headers = {"link": '<https://api.github.com/repositories/1/issues?page=2>; rel="next", '
+                                        '<https://api.github.com/repositories/1/issues?page=30>; rel="last"'}
+            response.json.return_value = pages[(params or {}).get('page', 1)]
+            return response
+
+        self.eb.PAGE_BATCH = 2
+        with patch.object(self.eb.session, 'get', side_effect=fake_get) as mocked_get:
+            self.eb.read_repo(True, period_days=8)
+        # The period starts 6 days ago, page 8 is the first one with an older issue,
+        # it is fetched in the batch of pages 8 and 9 and no later batch is requested
+        requested = [call[1]['params'].get('page', 1) for call in mocked_get.call_args_list]
+        self.assertEqual(sorted(requested), list(range(1, 10)))
+
+        # Reading the pages one after the other gives the same issues
+        open_issues, closed_issues = [], []
+        for page in range(1, 31):
+            for item in pages[page]:
+                if "pull_request" in item:
+                    continue
+                if not self.eb.start <= email_bot._parse_time(item['created_at']) <= self.eb.end:
+                    break
+                (open_issues if item['state'] == 'open' else closed_issues).append(item['number'])
+            else:
+                continue
+            break
+        self.assertTrue(open_issues and closed_issues)
+        self.assertEqual([item['number'] for item in self.eb.open_issues], open_issues)
+        self.assertEqual([item['number'] for item in self.eb.closed_issues], closed_issues)
+
+    def test_parse_time(self):
+        for timestamp in ("2018-08-04T18:27:17Z", "2018-12-31T23:59:59Z",
+                          "2020-02-29T00:00:00Z", "2019-01-01T09:05:03Z"):
+            self.assertEqual(email_bot._parse_time(timestamp),
+                             datetime.datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%SZ"))
 
 
 if __name__ == "__main__":
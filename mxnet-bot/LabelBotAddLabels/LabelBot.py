@@ -16,13 +16,78 @@
 # under the License.
 import json
 import os
-from botocore.vendored import requests
+import requests
 import re
 import logging
 import secret_manager
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+_CACHE_TTL = 120  # Seconds a cached GitHub response is reused without asking GitHub
+_CACHE_SIZE = 4096  # Limit for total cached GitHub responses
+_github_cache = {}
+_github_cache_lock = threading.Lock()
+_LABELS_TTL = 600  # Seconds the labels of a repo are reused without listing them again
+_labels_cache = {}
+_secret = None  # decoded Secrets Manager payload, read once per Lambda container
+# page number of the rel="last" link in the Link header of a listing
+_LAST_PAGE_RE = re.compile(r'[?&]page=(\d+)[^>]*>;\s*rel="last"')
+# shared by the sessions of all LabelBots, a warm Lambda container keeps its connections open
+_ADAPTER = HTTPAdapter(pool_connections=16, pool_maxsize=32,
+                       max_retries=Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 502, 503, 504],
+                                         respect_retry_after_header=True))
+
+
+def _github_get(session, url, params=None, auth=None):
+    """
+    This method is to send a GET request to the GitHub API through a TTL cache.
+    Expired entries are revalidated with their ETag (or Last-Modified date):
+    GitHub then answers 304 Not Modified, which does not count against the
+    rate limit, and the cached response is returned again.
+    Only successful responses are cached.
+    """
+    key = (url, frozenset(params.items()) if params else None)
+    entry = _github_cache.get(key)
+    if entry and time.monotonic() - entry[0] < _CACHE_TTL:
+        return entry[1]
+    headers = {}
+    if entry and 'ETag' in entry[1].headers:
+        headers['If-None-Match'] = entry[1].headers['ETag']
+    elif entry and 'Last-Modified' in entry[1].headers:
+        headers['If-Modified-Since'] = entry[1].headers['Last-Modified']
+    response = session.get(url, params=params, auth=auth, headers=headers)
+    if entry and response.status_code == 304:
+        response = entry[1]
+    elif response.status_code != 200:
+        return response
+    # the cache is shared by worker threads, evicting and inserting must not interleave
+    with _github_cache_lock:
+        if len(_github_cache) >= _CACHE_SIZE and key not in _github_cache:
+            # drop the oldest entry
+            del _github_cache[next(iter(_github_cache))]
+        _github_cache[key] = (time.monotonic(), response)
+    return response
+
+
+def _create_session():
+    """
+    This method is to create a requests session for the GitHub API.
+    Connections are pooled in _ADAPTER and kept alive between requests and invocations,
+    throttled or failed requests are retried with backoff (honouring Retry-After)
+    """
+    session = requests.Session()
+    session.mount('https://', _ADAPTER)
+    session.headers.update({'Accept': 'application/vnd.github+json'})
+    return session
 
 
 class LabelBot:
+    PER_PAGE = 100  # Limit for total issues/labels per page, the maximum GitHub allows
+    MAX_WORKERS = 8  # Limit for concurrent requests to GitHub
 
     def __init__(self, 
                  repo=os.environ.get("repo"), 
@@ -35,11 +100,12 @@ class LabelBot:
         if secret:
             self.get_secret()
         self.auth = (self.github_user, self.github_oauth_token)
+        self.session = _create_session()
+        self.session.auth = self.auth
         self.all_labels = None
 
     def get_rate_limit(self):
-        res = requests.get('https://api.github.com/{}'.format('rate_limit'),
-                     auth = self.auth)
+        res = self.session.get('https://api.github.com/{}'.format('rate_limit'))
         res.raise_for_status()
         data = res.json()['rate']
         return data['remaining']
@@ -47,8 +113,12 @@ class LabelBot:
     def get_secret(self):
         """
         This method is to get secret value from Secrets Manager
+        Warm Lambda containers reuse the secret read by a previous invocation
         """
-        secret = json.loads(secret_manager.get_secret())
+        global _secret
+        if _secret is None:
+            _secret = json.loads(secret_manager.get_secret())
+        secret = _secret
         self.github_user = secret["github_user"]
         self.github_oauth_token = secret["github_oauth_token"]
 
@@ -60,30 +130,25 @@ class LabelBot:
         labels = [' '.join(label.split()).lower() for label in substring.split(',')]
         return labels
 
-    def clean_string(self, raw_string, sub_string):
-        """
-        This method is to convert all non-alphanumeric characters from raw_string to sub_string
-        """
-        cleans = re.sub("[^0-9a-zA-Z]", sub_string, raw_string)
-        return cleans.lower()
-
     def count_pages(self, obj, state='open'):
         """
         This method is to count how many pages of issues/labels in total
         obj could be "issues"/"labels"
         state could be "open"/"closed"/"all", available to issues
+        Returns the count of pages and the first page's items
         """
         assert obj in set(["issues", "labels"]), "Invalid Input!"
         url = 'https://api.github.com/repos/{}/{}'.format(self.repo, obj)
         if obj == 'issues':
-            response = requests.get(url, {'state': state,
-                                          'per_page': 100}, auth=self.auth)
+            response = _github_get(self.session, url, {'state': state,
+                                                       'per_page': self.PER_PAGE})
         else:
-            response = requests.get(url, auth=self.auth)
+            response = _github_get(self.session, url, {'per_page': self.PER_PAGE})
         response.raise_for_status()
         if "link" not in response.headers:
-            return 1
-        return int(self.clean_string(response.headers['link'], " ").split()[-3])
+            return 1, response.json()
+        last_page = _LAST_PAGE_RE.search(response.headers['link'])
+        return int(last_page.group(1)) if last_page else 1, response.json()
 
     def find_notifications(self):
         """
@@ -91,18 +156,20 @@ class LabelBot:
         @:return [{"issue" : issue_id, "labels": []},...]
         """
         issues = []
-        pages = self.count_pages("issues")
+        # the first page is returned by count_pages
+        pages, items = self.count_pages("issues")
+        url = 'https://api.github.com/repos/{}/{}'.format(self.repo, 'issues')
         for page in range(1, pages+1):
-            url = 'https://api.github.com/repos/{}/{}'.format(self.repo, 'issues')
-            response = requests.get(url,
-                                    {'state': 'open',
-                                     'base': 'master',
-                                     'sort': 'created',
-                                     'direction': 'desc',
-                                     'page': page,
-                                     'per_page': 100},
-                                     auth=self.auth)
-            for item in response.json():
+            if page > 1:
+                response = self.session.get(url,
+                                            params={'state': 'open',
+                                                    'base': 'master',
+                                                    'sort': 'created',
+                                                    'direction': 'desc',
+                                                    'page': page,
+                                                    'per_page': self.PER_PAGE})
+                items = response.json()
+            for item in items:
                 # limit the amount of unlabeled issues per execution
                 if len(issues) >= 50:
                     break
@@ -110,11 +177,11 @@ class LabelBot:
                     if item['comments'] != 0:
                         labels = []
                         comments_url = "https://api.github.com/repos/{}/issues/{}/comments".format(self.repo,item['number'])
-                        comments = requests.get(comments_url, auth=self.auth).json()
+                        comments = self.session.get(comments_url).json()
                         for comment in comments:
                             if "@mxnet-label-bot" in comment['body']:
                                 labels += self.tokenize(comment['body'])
-                                logging.debug("issue: {}, comment: {}".format(str(item['number']),comment['body']))
+                                logging.debug("issue: %s, comment: %s", item['number'], comment['body'])
                         if labels != []:
                             issues.append({"issue": item['number'], "labels": labels})
         return issues
@@ -122,17 +189,24 @@ class LabelBot:
     def find_all_labels(self):
         """
         This method is to find all existing labels in the repo
-        """
-        pages = self.count_pages("labels")
-        all_labels = []
-        for page in range(1, pages+1):
+        Labels rarely change, so they are cached for _LABELS_TTL seconds
+        """
+        entry = _labels_cache.get(self.repo)
+        if entry and time.monotonic() - entry[0] < _LABELS_TTL:
+            self.all_labels = entry[1]
+            return self.all_labels
+        pages, items = self.count_pages("labels")
+        all_labels = [item['name'].lower() for item in items]
+        for page in range(2, pages+1):
             url = 'https://api.github.com/repos/' + self.repo + '/labels?page=' + str(page) \
-                + '&per_page=30'.format(repo=self.repo)
-            response = requests.get(url, auth=self.auth)
+                + '&per_page=' + str(self.PER_PAGE)
+            response = _github_get(self.session, url)
             for item in response.json():
                 all_labels.append(item['name'].lower())
-        self.all_labels = set(all_labels)
-        return set(all_labels)
+        # labels are stored lowercased in an immutable set, it is shared with the cache
+        self.all_labels = frozenset(all_labels)
+        _labels_cache[self.repo] = (time.monotonic(), self.all_labels)
+        return self.all_labels
 
     def add_github_labels(self, issue_num, labels):
         """
@@ -145,20 +219,23 @@ class LabelBot:
         issue_labels_url = 'https://api.github.com/repos/{repo}/issues/{id}/labels'\
                             .format(repo=self.repo, id=issue_num)
         # clean labels, remove duplicated spaces. ex: "hello  world" -> "hello world"
-        labels = [" ".join(label.split()) for label in labels]
-        labels = [label for label in labels if label.lower() in self.all_labels]
-        response = requests.post(issue_labels_url, json.dumps(labels), auth=self.auth)
+        labels = [label for label in (" ".join(label.split()) for label in labels)
+                  if label.lower() in self.all_labels]
+        response = self.session.post(issue_labels_url, json=labels)
         if response.status_code == 200:
-            logging.info('Successfully add labels to {}: {}.'.format(str(issue_num), str(labels)))
+            logging.info('Successfully add labels to %s: %s.', issue_num, labels)
         else:
             logging.error("Could not add the label")
-            logging.error(response.json())
+            logging.error(response.text)
 
     def label(self, issues):
         """
         This method is to add labels to multiple issues
         Input is a json file: [{number:1, labels:[a,b]},{number:2, labels:[c,d]}]
         """
+        if not issues:
+            return
         self.find_all_labels()
-        for issue in issues:
-            self.add_github_labels(issue['issue'], issue['labels'])
+        # issues are labelled concurrently, each one takes its own POST request
+        with ThreadPoolExecutor(max_workers=min(self.MAX_WORKERS, len(issues))) as executor:
+            list(executor.map(lambda issue: self.add_github_labels(issue['issue'], issue['labels']), issues))
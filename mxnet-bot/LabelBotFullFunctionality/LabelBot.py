@@ -14,19 +14,72 @@
 # KIND, either express or implied.  See the License for the
 # specific language governing permissions and limitations
 # under the License.
-import ast
+import functools
 import json
 import os
 import re
-from botocore.vendored import requests
+import requests
 import logging
 import secret_manager
 import hmac
 import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Command to the bot in a comment, ( add[label1] ) and ( add [label1] ) are treated the same way
+_BOT_COMMAND = re.compile(r'@mxnet-label-bot,?\s*(add|remove|update|replace)\s*(\[[^\]]*\])', re.IGNORECASE)
+# Any mention of the bot, checked on the raw payload without lowercasing it
+_BOT_MENTION = re.compile(r'@mxnet-label-bot', re.IGNORECASE)
+_WHITESPACE = re.compile(r'\s+')
+# Labels listed in brackets, i.e. "[label1, label2]"
+_BRACKETS = re.compile(r'\[([^\]]*)\]')
+# Page number of the rel="last" link in the link header of a paginated response
+_LAST_PAGE = re.compile(r'[?&]page=(\d+)[^>]*>;\s*rel="last"')
+_LABEL_TTL = 300  # Seconds the labels of a repo are reused by a warm Lambda container
+_LABEL_CACHE = {}  # repo -> (time the labels were listed, frozenset of the labels)
+_LABEL_PAGES = {}  # url of a label page -> (ETag, link header, label names of the page)
+_SECRET = None  # Decoded Secrets Manager payload, read once per Lambda container
+# The connection pool outlives the LabelBot of one invocation, so a warm Lambda container
+# keeps its connections to api.github.com open for the next webhooks
+_ADAPTER = HTTPAdapter(pool_connections=1, pool_maxsize=10,
+                       max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 502, 503, 504],
+                                         respect_retry_after_header=True))
+
+
+def _create_session(auth):
+    """
+    This method creates a requests session for the GitHub API
+    Connections to api.github.com are pooled in _ADAPTER and kept alive between requests,
+    and requests failing with a GitHub server error or throttled by GitHub (429)
+    are retried with backoff, waiting as long as the Retry-After header asks
+    :param auth: The default credentials of the session's requests
+    :return The configured session
+    """
+    session = requests.Session()
+    session.auth = auth
+    session.headers.update({"Accept": "application/vnd.github+json"})
+    session.mount('https://', _ADAPTER)
+    return session
+
+
+@functools.lru_cache(maxsize=256)
+def _bracketed_labels(string):
+    """
+    This method extracts the labels listed in brackets, memoized for redelivered comments
+    :param string: String parsed from a GitHub comment
+    :return Tuple of the lowercased labels
+    """
+    brackets = _BRACKETS.search(string)
+    if not brackets:
+        return ()
+    return tuple(_WHITESPACE.sub(' ', label).strip().lower() for label in brackets.group(1).split(','))
 
 
 class LabelBot:
-    LABEL_PAGE_PARSE = 30  # Limit for total labels per page to parse
+    LABEL_PAGE_PARSE = 100  # Limit for total labels per page to parse, the maximum GitHub allows
+    MAX_WORKERS = 8  # Limit for concurrent requests to GitHub
 
     def __init__(self,
                  repo=os.environ.get("repo"),
@@ -53,24 +106,54 @@ class LabelBot:
             self._get_secret()
         self.auth = (self.github_user, self.github_oauth_token)
         self.bot_auth = (self.bot_user, self.bot_oauth_token)
+        self.session = _create_session(self.auth)
+        # Every GitHub response reports the remaining rate limit, see _track_rate_limit
+        self._rate_limit_remaining = None
+        # Only requests sent with self.auth carry its Authorization header
+        self._auth_header = requests.Request('GET', 'https://api.github.com', auth=self.auth).prepare()\
+            .headers.get('Authorization')
+        self.session.hooks['response'].append(self._track_rate_limit)
+        # The repo is fixed for a bot, only the issue number is filled in per request
+        self._issue_labels_tmpl = f'https://api.github.com/repos/{self.repo}/issues/{{id}}/labels'
+        self._issue_comments_tmpl = f'https://api.github.com/repos/{self.repo}/issues/{{id}}/comments'
         self.all_labels = None
 
     def _get_rate_limit(self):
         """
         This method gets the remaining rate limit that is left from the GitHub API
+        The rate limit endpoint is only requested if no GitHub response was received yet
         :return Remaining API requests left that GitHub will allow
         """
-        res = requests.get('https://api.github.com/rate_limit',
-                           auth=self.auth)
+        if self._rate_limit_remaining is not None:
+            return self._rate_limit_remaining
+        res = self.session.get('https://api.github.com/rate_limit')
         res.raise_for_status()
         data = res.json()['rate']
         return data['remaining']
 
+    def _track_rate_limit(self, response, *args, **kwargs):
+        """
+        This method is a response hook of the session, it keeps the remaining rate limit
+        reported in the X-RateLimit-Remaining header of each GitHub response
+        Responses to requests sent with other credentials (i.e. self.bot_auth) report
+        the rate limit of another user, so they are ignored
+        :param response: The response received from GitHub
+        """
+        if response.request.headers.get('Authorization') != self._auth_header:
+            return
+        remaining = response.headers.get('X-RateLimit-Remaining')
+        if remaining is not None:
+            self._rate_limit_remaining = int(remaining)
+
     def _get_secret(self):
         """
         This method is to get secret value from Secrets Manager
+        Warm Lambda containers reuse the secret read by a previous invocation
         """
-        secret = json.loads(secret_manager.get_secret())
+        global _SECRET
+        if _SECRET is None:
+            _SECRET = json.loads(secret_manager.get_secret())
+        secret = _SECRET
         self.github_user = secret["github_user"]
         self.github_oauth_token = secret["github_oauth_token"]
         self.webhook_secret = secret["webhook_secret"]
@@ -78,50 +161,65 @@ class LabelBot:
         self.bot_oauth_token = secret["bot_oauth_token"]
         self.prediction_url = secret["prediction_url"]
 
-    def _tokenize(self, string):
+    @staticmethod
+    def _tokenize(string):
         """
         This method is to extract labels from comments
         :param string: String parsed from a GitHub comment
         :return Set of Labels which have been extracted
         """
-        substring = string[string.find('[') + 1: string.rfind(']')]
-        labels = [' '.join(label.split()).lower() for label in substring.split(',')]
-        return labels
+        return list(_bracketed_labels(string))
 
-    def _ascii_only(self, raw_string, sub_string):
+    def _get_label_page(self, url):
         """
-        This method is to convert all non-alphanumeric characters from raw_string to sub_string
-        :param raw_string The original string messy string
-        :param sub_string The string we want to convert to
-        :return Fully converted string
+        This method gets the labels of one page of the repo's labels
+        A page which was requested before is requested with its ETag, GitHub then answers
+        304 Not Modified if it did not change, which does not count against the rate limit
+        :param url: The url of the page
+        :return The link header of the page and the lowercased label names on the page
         """
-        converted_string = re.sub("[^0-9a-zA-Z]", sub_string, raw_string)
-        return converted_string.lower()
+        cached = _LABEL_PAGES.get(url)
+        headers = {"If-None-Match": cached[0]} if cached else {}
+        response = self.session.get(url, headers=headers)
+        if cached and response.status_code == 304:
+            return cached[1], cached[2]
+        response.raise_for_status()
+        link = response.headers.get('link')
+        names = tuple(item['name'].lower() for item in response.json())
+        if 'ETag' in response.headers:
+            _LABEL_PAGES[url] = (response.headers['ETag'], link, names)
+        return link, names
 
     def _find_all_labels(self):
         """
         This method finds all existing labels in the repo
         :return A set of all labels which have been extracted from the repo
         """
-        url = f'https://api.github.com/repos/{self.repo}/labels'
-        response = requests.get(url, auth=self.auth)
-        response.raise_for_status()
+        # Labels rarely change, they are cached for _LABEL_TTL seconds
+        entry = _LABEL_CACHE.get(self.repo)
+        if entry and time.monotonic() - entry[0] < _LABEL_TTL:
+            self.all_labels = entry[1]
+            return self.all_labels
+        url = f'https://api.github.com/repos/{self.repo}/labels?per_page={self.LABEL_PAGE_PARSE}'
+        link, names = self._get_label_page(url)
 
         # Getting total pages of labels present
-        if "link" not in response.headers:
-            pages = 1
-        else:
-            pages = int(self._ascii_only(response.headers['link'], " ").split()[-3])
-
-        all_labels = []
-        for page in range(1, pages + 1):
-            url = 'https://api.github.com/repos/' + self.repo + '/labels?page=' + str(page) \
-                  + '&per_page=%s' % self.LABEL_PAGE_PARSE
-            response = requests.get(url, auth=self.auth)
-            for item in response.json():
-                all_labels.append(item['name'].lower())
-        self.all_labels = set(all_labels)
-        return set(all_labels)
+        last_page = _LAST_PAGE.search(link) if link else None
+        pages = int(last_page.group(1)) if last_page else 1
+
+        # The first page was already requested to count the pages
+        all_labels = list(names)
+        urls = ['https://api.github.com/repos/' + self.repo + '/labels?page=' + str(page)
+                + '&per_page=%s' % self.LABEL_PAGE_PARSE for page in range(2, pages + 1)]
+        if urls:
+            # The remaining pages are requested concurrently
+            with ThreadPoolExecutor(max_workers=min(self.MAX_WORKERS, len(urls))) as executor:
+                for _, names in executor.map(self._get_label_page, urls):
+                    all_labels += names
+        # The set is shared with the cache, so it is immutable
+        self.all_labels = frozenset(all_labels)
+        _LABEL_CACHE[self.repo] = (time.monotonic(), self.all_labels)
+        return self.all_labels
 
     def _format_labels(self, labels):
         """
@@ -130,11 +228,14 @@ class LabelBot:
         :param labels: The messy labels inputted by the user which we want to format
         :return: Formatted labels to send for CRUD operations
         """
-        assert self.all_labels, "Find all labels first"
+        if self.all_labels is None:
+            self._find_all_labels()
+        elif not isinstance(self.all_labels, frozenset):
+            # Labels set by the caller, i.e. a list, are stored as a frozenset for constant time lookups
+            self.all_labels = frozenset(label.lower() for label in self.all_labels)
         # clean labels, remove duplicated spaces. ex: "hello  world" -> "hello world"
-        labels = [" ".join(label.split()) for label in labels]
-        labels = [label for label in labels if label.lower() in self.all_labels]
-        return labels
+        cleaned = (_WHITESPACE.sub(' ', label).strip() for label in labels)
+        return [label for label in cleaned if label.lower() in self.all_labels]
 
     def add_labels(self, issue_num, labels):
         """
@@ -145,14 +246,13 @@ class LabelBot:
         :return Response denoting success or failure for logging purposes
         """
         labels = self._format_labels(labels)
-        issue_labels_url = f'https://api.github.com/repos/{self.repo}/issues/{issue_num}/labels'
-        response = requests.post(issue_labels_url, json.dumps(labels), auth=self.auth)
+        issue_labels_url = self._issue_labels_tmpl.format(id=issue_num)
+        response = self.session.post(issue_labels_url, json=labels)
         if response.status_code == 200:
-            logging.info(f'Successfully added labels to {issue_num}: {labels}.')
+            logging.info('Successfully added labels to %s: %s.', issue_num, labels)
             return True
         else:
-            logging.error(f'Could not add the labels to {issue_num}: {labels}. '
-                          f'\nResponse: {json.dumps(response.json())}')
+            logging.error('Could not add the labels to %s: %s. \nResponse: %s', issue_num, labels, response.text)
             return False
 
     def remove_labels(self, issue_num, labels):
@@ -164,18 +264,21 @@ class LabelBot:
         :return Response denoting success or failure for logging purposes
         """
         labels = self._format_labels(labels)
-        issue_labels_url = f'https://api.github.com/repos/{self.repo}/issues/{issue_num}/labels/'
+        if not labels:
+            return True
+        issue_labels_url = self._issue_labels_tmpl.format(id=issue_num) + '/'
 
-        for label in labels:
-            delete_label_url = issue_labels_url + label
-            response = requests.delete(delete_label_url, auth=self.auth)
+        def remove_label(label):
+            response = self.session.delete(issue_labels_url + label)
             if response.status_code == 200:
-                logging.info(f'Successfully removed label to {issue_num}: {label}.')
-            else:
-                logging.error(f'Could not remove the label to {issue_num}: {label}. '
-                              f'\nResponse: {json.dumps(response.json())}')
-                return False
-        return True
+                logging.info('Successfully removed label to %s: %s.', issue_num, label)
+                return True
+            logging.error('Could not remove the label to %s: %s. \nResponse: %s', issue_num, label, response.text)
+            return False
+
+        # Each label is removed by its own DELETE request, so they are sent concurrently
+        with ThreadPoolExecutor(max_workers=min(self.MAX_WORKERS, len(labels))) as executor:
+            return all(list(executor.map(remove_label, labels)))
 
     def update_labels(self, issue_num, labels):
         """
@@ -186,15 +289,14 @@ class LabelBot:
         :return Response denoting success or failure for logging purposes
         """
         labels = self._format_labels(labels)
-        issue_labels_url = f'https://api.github.com/repos/{self.repo}/issues/{issue_num}/labels'
+        issue_labels_url = self._issue_labels_tmpl.format(id=issue_num)
 
-        response = requests.put(issue_labels_url, data=json.dumps(labels), auth=self.auth)
+        response = self.session.put(issue_labels_url, json=labels)
         if response.status_code == 200:
-            logging.info(f'Successfully updated labels to {issue_num}: {labels}.')
+            logging.info('Successfully updated labels to %s: %s.', issue_num, labels)
             return True
         else:
-            logging.error(f'Could not update the labels to {issue_num}: {labels}. '
-                          f'\nResponse: {json.dumps(response.json())}')
+            logging.error('Could not update the labels to %s: %s. \nResponse: %s', issue_num, labels, response.text)
             return False
 
     def replace_label(self, issue_num, labels):
@@ -208,7 +310,7 @@ class LabelBot:
         if len(labels) != 2:
             logging.error('Must only specify 2 labels when wanting to change labels')
             return False
-        logging.info('Label on {} to change from: {} to {}'.format(str(issue_num), str(labels[0]), str(labels[1])))
+        logging.info('Label on %s to change from: %s to %s', issue_num, labels[0], labels[1])
         if self.remove_labels(issue_num, [labels[0]]) and self.add_labels(issue_num, [labels[1]]):
             return True
         else:
@@ -217,12 +319,12 @@ class LabelBot:
     def predict_label(self, issue_num):
 
         predict_issue = {"issues": [issue_num]}
-        header = {"Content-Type": 'application/json'}
-        response = requests.post(self.prediction_url, data=json.dumps(predict_issue), headers=header)
+        # Not sent through self.session, the prediction service must not receive the GitHub credentials
+        response = requests.post(self.prediction_url, json=predict_issue)
         predicted_labels = response.json()[0]["predictions"]
 
         if response.status_code == 200:
-            logging.info(f'Successfully predicted labels to {issue_num}: {predicted_labels}')
+            logging.info('Successfully predicted labels to %s: %s', issue_num, predicted_labels)
         else:
             logging.error("Unable to predict labels")
             return False
@@ -231,7 +333,7 @@ class LabelBot:
             message = "Hey, this is the MXNet Label Bot and I think you have raised a question. \n" \
                       "For questions, you can also submit on MXNet discussion forum (https://discuss.mxnet.io), " \
                       "where it will get a wider audience and allow others to learn as well. Thanks! \n "
-            self.add_github_labels(issue_num, ['question'])
+            self.add_labels(issue_num, ['question'])
 
         else:
             message = "Hey, this is the MXNet Label Bot. \n Thank you for submitting the issue! I will try and " \
@@ -251,14 +353,15 @@ class LabelBot:
         :return Response denoting success or failure for logging purposes
         """
         send_msg = {"body": message}
-        issue_comments_url = f'https://api.github.com/repos/{self.repo}/issues/{issue_num}/comments'
+        issue_comments_url = self._issue_comments_tmpl.format(id=issue_num)
 
-        response = requests.post(issue_comments_url, data=json.dumps(send_msg), auth=self.bot_auth)
+        response = self.session.post(issue_comments_url, json=send_msg, auth=self.bot_auth)
         if response.status_code == 201:
-            logging.info(f'Successfully commented {send_msg} to: {issue_num}')
+            logging.info('Successfully commented to: %s', issue_num)
+            logging.debug('Comment: %s', message)
             return True
         else:
-            logging.error(f'Could not comment \n {json.dumps(response.json())}')
+            logging.error('Could not comment \n %s', response.text)
             return False
 
     def label_action(self, actions):
@@ -268,36 +371,38 @@ class LabelBot:
         :param actions: The action we want to take on the label
         :return Response denoting success or failure for logging purposes
         """
-        if "add" in actions:
-            return self.add_labels(actions["add"][0], actions["add"][1])
-        elif "remove" in actions:
-            return self.remove_labels(actions["remove"][0], actions["remove"][1])
-        elif "update" in actions:
-            return self.update_labels(actions["update"][0], actions["update"][1])
-        elif "replace" in actions:
-            return self.replace_label(actions["replace"][0], actions["replace"][1])
-        else:
-            return False
-
-    def _secure_webhook(self, event):
+        action_methods = {"add": self.add_labels,
+                          "remove": self.remove_labels,
+                          "update": self.update_labels,
+                          "replace": self.replace_label}
+        for action, (issue_num, labels) in actions.items():
+            if action in action_methods:
+                return action_methods[action](issue_num, labels)
+        return False
+
+    def _secure_webhook(self, record):
         """
         This method will validate the security of the webhook, it confirms that the secret
         of the webhook is matched and that each github event is signed appropriately
-        :param event: The github event we want to validate
+        :param record: The SQS record of the github event we want to validate
         :return Response denoting success or failure of security
         """
 
-        # Validating github event is signed
-        try:
-            git_signed = ast.literal_eval(event["Records"][0]['body'])['headers']["X-Hub-Signature"]
-        except KeyError:
+        # Validating github event is signed, the SHA-256 signature is preferred over the legacy SHA-1 one
+        attributes = record['messageAttributes']
+        if "X-Hub-Signature-256" in attributes:
+            git_signed, digestmod = attributes["X-Hub-Signature-256"]['stringValue'], hashlib.sha256
+        elif "X-Hub-Signature" in attributes:
+            git_signed, digestmod = attributes["X-Hub-Signature"]['stringValue'], hashlib.sha1
+        else:
             raise Exception("WebHook from GitHub is not signed")
-        git_signed = git_signed.replace('sha1=', '')
+        # i.e. "sha256=<hex digest>"
+        git_signed = git_signed.partition('=')[2]
 
         # Signing our event with the same secret as what we assigned to github event
         secret = self.webhook_secret
-        body = ast.literal_eval(event["Records"][0]['body'])['body']
-        secret_sign = hmac.new(key=secret.encode('utf-8'), msg=body.encode('utf-8'), digestmod=hashlib.sha1).hexdigest()
+        body = record['body']
+        secret_sign = hmac.new(key=secret.encode('utf-8'), msg=body.encode('utf-8'), digestmod=digestmod).hexdigest()
 
         # Validating signatures match
         return hmac.compare_digest(git_signed, secret_sign)
@@ -309,16 +414,27 @@ class LabelBot:
         :param event: The event data that is received whenever a github issue, issue comment, etc. is made
         :return: Log statements which we can track in lambda
         """
+        # The SQS message body is the GitHub payload, the webhook headers are
+        # its message attributes, see handler.send_to_sqs
+        record = event["Records"][0]
         try:
-            github_event = ast.literal_eval(event["Records"][0]['body'])['headers']["X-GitHub-Event"]
+            github_event = record['messageAttributes']["X-GitHub-Event"]['stringValue']
         except KeyError:
             raise Exception("Not a GitHub Event")
 
-        if not self._secure_webhook(event):
+        # Most webhooks are ignored, drop them before verifying and decoding the payload
+        if github_event not in ("issue_comment", "issues"):
+            logging.info('GitHub Event unsupported by Label Bot: %s', github_event)
+            return
+        if github_event == "issue_comment" and not _BOT_MENTION.search(record['body']):
+            logging.info('Comment does not mention the Label Bot')
+            return
+
+        if not self._secure_webhook(record):
             raise Exception("Failed to validate WebHook security")
 
         try:
-            payload = json.loads(ast.literal_eval(event["Records"][0]['body'])['body'])
+            payload = json.loads(record['body'])
         except ValueError:
             raise Exception("Decoding JSON for payload failed")
 
@@ -329,42 +445,51 @@ class LabelBot:
             labels = []
             actions = {}
 
-            # Looks for and reads phrase referencing @mxnet-label-bot, and trims extra whitespace to single space
-            if "@mxnet-label-bot" in payload["comment"]["body"]:
-                phrase = payload["comment"]["body"][payload["comment"]["body"].find("@mxnet-label-bot"):payload["comment"]["body"].find("]")+1]
-                phrase = ' '.join(phrase.split())
-
-                labels += self._tokenize(phrase)
+            # Looks for a command to @mxnet-label-bot, i.e. "@mxnet-label-bot add [label1, label2]"
+            comment = payload["comment"]
+            # Comments posted by the bot itself are never commands
+            if comment.get("user", {}).get("login") == self.bot_user:
+                logging.info('Ignoring a comment of the Label Bot')
+                return
+            command = _BOT_COMMAND.search(comment["body"])
+            if command:
+                # Trims extra whitespace to single space
+                phrase = ' '.join(command.group(0).split())
+                action = command.group(1).lower()
+
+                labels += self._tokenize(command.group(2))
                 if not labels:
-                    logging.error(f'Message typed by user: {phrase}')
+                    logging.error('Message typed by user: %s', phrase)
                     raise Exception("Unable to gather labels from issue comments")
 
                 self._find_all_labels()
                 if not self.all_labels:
                     raise Exception("Unable to gather labels from the repo")
 
-                if not set(labels).intersection(set(self.all_labels)):
-                    logging.error(f'Labels entered by user: {set(labels)}')
-                    logging.error(f'Repo labels: {set(self.all_labels)}')
+                # Labels are lowercased by _tokenize, as the repo labels are
+                if self.all_labels.isdisjoint(labels):
+                    logging.error('Labels entered by user: %s', labels)
+                    logging.error('Repo labels: %s', self.all_labels)
                     raise Exception("Provided labels don't match labels from the repo")
 
-                # Case so that ( add[label1] ) and ( add [label1] ) are treated the same way
-                if phrase.split(" ")[1].find('[') != -1:
-                    action = phrase.split(" ")[1][:phrase.split(" ")[1].find('[')].lower()
-                else:
-                    action = phrase.split(" ")[1].lower()
-
                 issue_num = payload["issue"]["number"]
                 actions[action] = issue_num, labels
                 if not self.label_action(actions):
-                    logging.error(f'Unsupported actions: {actions}')
+                    logging.error('Unsupported actions: %s', actions)
                     raise Exception("Unrecognized/Infeasible label action for the mxnet-label-bot")
+            elif not _BOT_MENTION.search(comment["body"]):
+                # The mention found in the raw payload is in the issue, not in this comment
+                logging.info('Comment does not mention the Label Bot')
+                return
+            else:
+                # The bot is mentioned, but not with "<action> [labels]"
+                logging.error('Unrecognized command to the Label Bot: %s', comment["body"])
+                raise Exception("Unrecognized/Infeasible label action for the mxnet-label-bot")
 
         # On creation of a new issue, automatically trigger the bot to recommend labels
-        if github_event == "issues" and payload["action"] == "opened":
-            self._find_all_labels()
+        elif github_event == "issues" and payload["action"] == "opened":
             return self.predict_label(payload["issue"]["number"])
 
         else:
-            logging.info(f'GitHub Event unsupported by Label Bot: {github_event} {payload["action"]}')
+            logging.info('GitHub Event unsupported by Label Bot: %s %s', github_event, payload["action"])
 
@@ -23,16 +23,23 @@ logging.getLogger().setLevel(logging.INFO)
 logging.getLogger('boto3').setLevel(logging.CRITICAL)
 logging.getLogger('botocore').setLevel(logging.CRITICAL)
 SQS_CLIENT = boto3.client('sqs')
+# Webhook headers needed by the label bot, they are sent as SQS message attributes
+WEBHOOK_HEADERS = ("X-GitHub-Event", "X-Hub-Signature", "X-Hub-Signature-256")
 
 
 def send_to_sqs(event, context):
 
+    # The GitHub payload is forwarded as is, LabelBot verifies its signature against these exact bytes
+    headers = event.get("headers") or {}
+    attributes = {name: {"DataType": "String", "StringValue": headers[name]}
+                  for name in WEBHOOK_HEADERS if headers.get(name)}
     response = (SQS_CLIENT.send_message(
         QueueUrl=os.getenv('SQS_URL'),
-        MessageBody=str(event)
+        MessageBody=event.get("body") or "{}",
+        MessageAttributes=attributes
         ))
 
-    logging.info('Response: {}'.format(response))
+    logging.debug('Response: %s', response)
     status = response['ResponseMetadata']['HTTPStatusCode']
     if status == 200:
         logging.info('Enqueued to SQS')
@@ -56,7 +63,7 @@ def label_bot_lambda(event, context):
         except:
             logging.error("Label bot raised an exception!")
         remaining = label_bot._get_rate_limit()
-        logging.info("Lambda is triggered successfully! (remaining HTTP request: {})".format(remaining))
+        logging.info("Lambda is triggered successfully! (remaining HTTP request: %s)", remaining)
     else:
-        logging.info("Lambda failed triggered (out of limits: {})".format(remaining))
+        logging.info("Lambda failed triggered (out of limits: %s)", remaining)
 
@@ -15,7 +15,12 @@
 # specific language governing permissions and limitations
 # under the License.
 import unittest
-import ast
+import hashlib
+import hmac
+import json
+import time
+import requests
+import LabelBot as label_bot
 from LabelBot import LabelBot
 
 # some version issue
@@ -24,94 +29,266 @@ try:
 except ImportError:
     from mock import patch
 
+# handler creates its SQS client at import, which needs AWS configuration
+with patch('boto3.client'):
+    import handler
+
 
 class TestLabelBot(unittest.TestCase):
     """
     Unittest of LabelBot.py
     """
     def setUp(self):
+        # labels and secrets cached by earlier tests must not leak into the next one
+        label_bot._LABEL_CACHE.clear()
+        label_bot._LABEL_PAGES.clear()
+        label_bot._SECRET = None
         self.lb = LabelBot(repo="harshp8l/mxnet-infrastructure",  apply_secret=True)
 
+    def _seed_repo_labels(self, *labels):
+        """
+        Caches the labels of the repo, so that parse_webhook_data does not list them from GitHub
+        """
+        label_bot._LABEL_CACHE[self.lb.repo] = (time.monotonic(), frozenset(labels))
+
+    @staticmethod
+    def _webhook_event(github_event, payload):
+        """
+        Builds the SQS event of an unsigned webhook, as sent by handler.send_to_sqs
+        """
+        return {"Records": [{"body": json.dumps(payload),
+                             "messageAttributes": {"X-GitHub-Event": {"stringValue": github_event,
+                                                                      "dataType": "String"}}}]}
+
     # Tests for basic functionality
     def test_add_labels(self):
-        with patch('LabelBot.requests.post') as mocked_post:
+        with patch.object(self.lb.session, 'post') as mocked_post:
             mocked_post.return_value.status_code = 200
-            self.lb.all_labels = ['sample_label', 'another_label', 'all_labels']
+            self.lb.all_labels = {'sample_label', 'another_label', 'all_labels'}
             self.assertTrue(self.lb.add_labels(issue_num=0, labels=['sample_label']))
 
     def test_remove_labels(self):
-        with patch('LabelBot.requests.delete') as mocked_delete:
+        with patch.object(self.lb.session, 'delete') as mocked_delete:
             mocked_delete.return_value.status_code = 200
-            self.lb.all_labels = ['sample_label', 'another_label', 'all_labels']
+            self.lb.all_labels = {'sample_label', 'another_label', 'all_labels'}
             self.assertTrue(self.lb.remove_labels(issue_num=0, labels=['sample_label']))
 
     def test_update_labels(self):
-        with patch('LabelBot.requests.put') as mocked_put:
+        with patch.object(self.lb.session, 'put') as mocked_put:
             mocked_put.return_value.status_code = 200
-            self.lb.all_labels = ['sample_label', 'another_label', 'all_labels']
+            self.lb.all_labels = {'sample_label', 'another_label', 'all_labels'}
             self.assertTrue(self.lb.update_labels(issue_num=0, labels=['sample_label']))
 
     # Tests for different kinds of user input
     # Tests for spaces
     def test_tokenize_frontSpace(self):
-        user_label = LabelBot._tokenize(LabelBot.__class__, "[   Sample Label]")
+        user_label = LabelBot._tokenize("[   Sample Label]")
         self.assertEqual(user_label, ['sample label'])
 
     def test_tokenize_endSpace(self):
-        user_label = LabelBot._tokenize(LabelBot.__class__, "[ Sample Label      ]")
+        user_label = LabelBot._tokenize("[ Sample Label      ]")
         self.assertEqual(user_label, ['sample label'])
 
     def test_tokenize_midSpace(self):
-        user_label = LabelBot._tokenize(LabelBot.__class__, "[Sample        Label]")
+        user_label = LabelBot._tokenize("[Sample        Label]")
         self.assertEqual(user_label, ['sample label'])
 
     def test_tokenize_manyWordsSpace(self):
-        user_label = LabelBot._tokenize(LabelBot.__class__, "[This    is    a     sample    label]")
+        user_label = LabelBot._tokenize("[This    is    a     sample    label]")
         self.assertEqual(user_label, ['this is a sample label'])
 
     # Tests for case-insensitive
     def test_tokenize_upperCase(self):
-        user_label = LabelBot._tokenize(LabelBot.__class__, "[SAMPLE LABEL, ANOTHER LABEL, FINAL]")
+        user_label = LabelBot._tokenize("[SAMPLE LABEL, ANOTHER LABEL, FINAL]")
         self.assertEqual(user_label, ['sample label', 'another label', 'final'])
 
     def test_tokenize_mixCase(self):
-        user_label = LabelBot._tokenize(LabelBot.__class__, "[sAmPlE LaBeL, AnOtHeR lAbEl, fInAl]")
+        user_label = LabelBot._tokenize("[sAmPlE LaBeL, AnOtHeR lAbEl, fInAl]")
         self.assertEqual(user_label, ['sample label', 'another label', 'final'])
 
     def test_tokenize_lowerCase(self):
-        user_label = LabelBot._tokenize(LabelBot.__class__, "[sample label, another label, final]")
+        user_label = LabelBot._tokenize("[sample label, another label, final]")
         self.assertEqual(user_label, ['sample label', 'another label', 'final'])
 
+    # Tests for tracking the rate limit of self.auth
+    def _github_response(self, auth, remaining):
+        response = requests.Response()
+        response.request = requests.Request('POST', 'https://api.github.com/repos', auth=auth).prepare()
+        response.headers['X-RateLimit-Remaining'] = str(remaining)
+        return response
+
+    def test_track_rate_limit(self):
+        self.lb = LabelBot(repo=self.lb.repo, github_user="user", github_oauth_token="token",
+                           bot_user="bot", bot_oauth_token="bot_token", apply_secret=False)
+        self.lb._track_rate_limit(self._github_response(self.lb.auth, 4500))
+        self.assertEqual(self.lb._get_rate_limit(), 4500)
+        # Requests of the bot user report its own rate limit
+        self.lb._track_rate_limit(self._github_response(self.lb.bot_auth, 100))
+        self.assertEqual(self.lb._get_rate_limit(), 4500)
+
     # Tests for parsing data from github comments
     # Referencing @mxnet-label-bot from different places in the comment body
     def test_parse_webhook_data_referencedAtEnd(self):
+        self._seed_repo_labels('bug', 'duplicate', 'question')
         with open("testInputFiles/testAtEnd.json", "r") as fh:
-            token = ast.literal_eval(fh.read())
+            token = json.load(fh)
             with patch.object(LabelBot, '_secure_webhook', return_value=True):
-                with patch.object(LabelBot, 'add_labels', return_value=True):
+                with patch.object(LabelBot, 'add_labels', return_value=True) as mocked_add:
                     self.lb.parse_webhook_data(token)
+                    mocked_add.assert_called_once_with(0, ['bug', 'duplicate'])
 
     def test_parse_webhook_data_referencedAtStart(self):
+        self._seed_repo_labels('bug', 'duplicate', 'question')
         with open("testInputFiles/testAtStart.json", "r") as fh:
-            token = ast.literal_eval(fh.read())
+            token = json.load(fh)
             with patch.object(LabelBot, '_secure_webhook', return_value=True):
-                with patch.object(LabelBot, 'add_labels', return_value=True):
+                with patch.object(LabelBot, 'add_labels', return_value=True) as mocked_add:
                     self.lb.parse_webhook_data(token)
+                    mocked_add.assert_called_once_with(0, ['bug', 'duplicate'])
 
     def test_parse_webhook_data_referencedAtMid(self):
+        self._seed_repo_labels('bug', 'duplicate', 'question')
         with open("testInputFiles/testAtMid.json", "r") as fh:
-            token = ast.literal_eval(fh.read())
+            token = json.load(fh)
             with patch.object(LabelBot, '_secure_webhook', return_value=True):
-                with patch.object(LabelBot, 'add_labels', return_value=True):
-                    print(self.lb.parse_webhook_data(token))
+                with patch.object(LabelBot, 'add_labels', return_value=True) as mocked_add:
+                    self.lb.parse_webhook_data(token)
+                    mocked_add.assert_called_once_with(0, ['bug', 'duplicate'])
 
     # Test if actions are triggered with different user inputs ( i.e. add[label] )
     def test_parse_webhook_data_actionNoSpace(self):
+        self._seed_repo_labels('bug', 'duplicate', 'question')
         with open("testInputFiles/testNoSpace.json", "r") as fh:
-            token = ast.literal_eval(fh.read())
+            token = json.load(fh)
+            with patch.object(LabelBot, '_secure_webhook', return_value=True):
+                with patch.object(LabelBot, 'add_labels', return_value=True) as mocked_add:
+                    self.lb.parse_webhook_data(token)
+                    mocked_add.assert_called_once_with(0, ['bug', 'duplicate'])
+
+    # Tests for webhooks which are dropped before any label action
+    def test_parse_webhook_data_unsupportedEvent(self):
+        token = self._webhook_event("pull_request", {"action": "opened"})
+        with patch.object(LabelBot, '_secure_webhook') as mocked_secure:
+            with patch.object(LabelBot, '_find_all_labels') as mocked_find:
+                self.assertIsNone(self.lb.parse_webhook_data(token))
+                mocked_secure.assert_not_called()
+                mocked_find.assert_not_called()
+
+    def test_parse_webhook_data_noMention(self):
+        token = self._webhook_event("issue_comment", {"action": "created",
+                                                      "comment": {"body": "add [bug]"},
+                                                      "issue": {"number": 0}})
+        with patch.object(LabelBot, '_secure_webhook') as mocked_secure:
+            with patch.object(LabelBot, '_find_all_labels') as mocked_find:
+                self.assertIsNone(self.lb.parse_webhook_data(token))
+                mocked_secure.assert_not_called()
+                mocked_find.assert_not_called()
+
+    def test_parse_webhook_data_ownComment(self):
+        self.lb.bot_user = "mxnet-label-bot"
+        token = self._webhook_event("issue_comment", {"action": "created",
+                                                      "comment": {"body": "@mxnet-label-bot add [bug]",
+                                                                  "user": {"login": "mxnet-label-bot"}},
+                                                      "issue": {"number": 0}})
+        with patch.object(LabelBot, '_secure_webhook', return_value=True):
+            with patch.object(LabelBot, '_find_all_labels') as mocked_find:
+                with patch.object(LabelBot, 'add_labels') as mocked_add:
+                    self.assertIsNone(self.lb.parse_webhook_data(token))
+                    mocked_find.assert_not_called()
+                    mocked_add.assert_not_called()
+
+    def test_parse_webhook_data_unrecognizedCommand(self):
+        self._seed_repo_labels('bug', 'duplicate', 'question')
+        for comment in ("@mxnet-label-bot foo [bug]", "@mxnet-label-bot add bug"):
+            token = self._webhook_event("issue_comment", {"action": "created",
+                                                          "comment": {"body": comment},
+                                                          "issue": {"number": 0}})
             with patch.object(LabelBot, '_secure_webhook', return_value=True):
-                with patch.object(LabelBot, 'add_labels', return_value=True):
-                    print(self.lb.parse_webhook_data(token))
+                with patch.object(LabelBot, 'add_labels') as mocked_add:
+                    with self.assertRaises(Exception):
+                        self.lb.parse_webhook_data(token)
+                    mocked_add.assert_not_called()
+
+    def test_parse_webhook_data_mentionInIssueOnly(self):
+        token = self._webhook_event("issue_comment", {"action": "created",
+                                                      "comment": {"body": "Thanks, I can reproduce this too."},
+                                                      "issue": {"number": 0,
+                                                                "body": "@mxnet-label-bot add [bug]"}})
+        with patch.object(LabelBot, '_secure_webhook', return_value=True):
+            with patch.object(LabelBot, '_find_all_labels') as mocked_find:
+                with patch.object(LabelBot, 'add_labels') as mocked_add:
+                    self.assertIsNone(self.lb.parse_webhook_data(token))
+                    mocked_find.assert_not_called()
+                    mocked_add.assert_not_called()
+
+    # Tests for forwarding the webhook to SQS
+    def test_send_to_sqs(self):
+        body = '{"action": "created", "comment": {"body": "@mxnet-label-bot add [bug]"}}'
+        event = {"body": body,
+                 "headers": {"X-GitHub-Event": "issue_comment",
+                             "X-Hub-Signature-256": "sha256=XXXXXXXXXXX",
+                             "User-Agent": "GitHub-Hookshot/0000000"}}
+        with patch.object(handler, 'SQS_CLIENT') as mocked_sqs:
+            mocked_sqs.send_message.return_value = {'ResponseMetadata': {'HTTPStatusCode': 200}}
+            self.assertEqual(handler.send_to_sqs(event, None)["statusCode"], 200)
+            kwargs = mocked_sqs.send_message.call_args[1]
+            # The body must reach the bot byte for byte, its signature is computed over it
+            self.assertEqual(kwargs["MessageBody"], body)
+            self.assertEqual(kwargs["MessageAttributes"],
+                             {"X-GitHub-Event": {"DataType": "String", "StringValue": "issue_comment"},
+                              "X-Hub-Signature-256": {"DataType": "String",
+                                                      "StringValue": "sha256=XXXXXXXXXXX"}})
+
+    # Tests for validating the signature of the webhook
+    @staticmethod
+    def _signed_record(body, secret, headers):
+        """
+        Builds the SQS record of a webhook, headers maps a signature header to its digest algorithm
+        """
+        attributes = {"X-GitHub-Event": {"stringValue": "issue_comment", "dataType": "String"}}
+        for header, (digestmod, prefix) in headers.items():
+            signature = hmac.new(secret.encode('utf-8'), body.encode('utf-8'), digestmod).hexdigest()
+            attributes[header] = {"stringValue": prefix + '=' + signature, "dataType": "String"}
+        return {"body": body, "messageAttributes": attributes}
+
+    def test_secure_webhook_sha256(self):
+        self.lb.webhook_secret = "secret"
+        record = self._signed_record('{"action": "created"}', "secret",
+                                     {"X-Hub-Signature-256": (hashlib.sha256, "sha256")})
+        self.assertTrue(self.lb._secure_webhook(record))
+
+    def test_secure_webhook_sha1Fallback(self):
+        self.lb.webhook_secret = "secret"
+        record = self._signed_record('{"action": "created"}', "secret",
+                                     {"X-Hub-Signature": (hashlib.sha1, "sha1")})
+        self.assertTrue(self.lb._secure_webhook(record))
+
+    def test_secure_webhook_sha256Preferred(self):
+        self.lb.webhook_secret = "secret"
+        # Only the SHA-256 signature is valid, it must be the one which is checked
+        record = self._signed_record('{"action": "created"}', "secret",
+                                     {"X-Hub-Signature-256": (hashlib.sha256, "sha256")})
+        record["messageAttributes"]["X-Hub-Signature"] = {"stringValue": "sha1=XXXXXXXXXXX", "dataType": "String"}
+        self.assertTrue(self.lb._secure_webhook(record))
+        # Only the SHA-1 signature is valid
+        record = self._signed_record('{"action": "created"}', "secret",
+                                     {"X-Hub-Signature": (hashlib.sha1, "sha1")})
+        record["messageAttributes"]["X-Hub-Signature-256"] = {"stringValue": "sha256=XXXXXXXXXXX",
+                                                              "dataType": "String"}
+        self.assertFalse(self.lb._secure_webhook(record))
+
+    def test_secure_webhook_tamperedBody(self):
+        self.lb.webhook_secret = "secret"
+        record = self._signed_record('{"action": "created"}', "secret",
+                                     {"X-Hub-Signature-256": (hashlib.sha256, "sha256")})
+        record["body"] = '{"action": "deleted"}'
+        self.assertFalse(self.lb._secure_webhook(record))
+
+    def test_secure_webhook_notSigned(self):
+        self.lb.webhook_secret = "secret"
+        record = self._signed_record('{"action": "created"}', "secret", {})
+        with self.assertRaises(Exception):
+            self.lb._secure_webhook(record)
 
 
 if __name__ == "__main__":